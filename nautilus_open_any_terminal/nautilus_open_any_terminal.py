@@ -1,22 +1,16 @@
 """nautilus extension: nautilus_open_any_terminal"""
 # based on: https://github.com/gnunn1/tilix/blob/master/data/nautilus/open-tilix.py
 
-import ast
+import os
 import re
-import shlex
+import sys
 from dataclasses import dataclass, field
-from functools import cache
+from functools import lru_cache
 from gettext import gettext, translation
 from os.path import expanduser
 from subprocess import Popen
-from typing import Optional
-
-try:
-    from urllib import unquote  # type: ignore
-
-    from urlparse import urlparse
-except ImportError:
-    from urllib.parse import unquote, urlparse
+from types import MappingProxyType
+from typing import Callable, Mapping, Optional, Sequence
 
 from gi import get_required_version, require_version
 
@@ -27,7 +21,7 @@ if API_VERSION == "4.0":
 else:
     require_version("Gtk", "3.0")
 
-from gi.repository import Gio, GObject, Gtk, Nautilus  # noqa: E402 # pylint: disable=wrong-import-position
+from gi.repository import Gio, GObject, Nautilus  # noqa: E402 # pylint: disable=wrong-import-position
 
 
 @dataclass(frozen=True)
@@ -42,7 +36,33 @@ class Terminal:
     flatpak_package: Optional[str] = None
 
 
-TERMINALS = {
+@dataclass(frozen=True)
+class Config:
+    """Data class holding everything derived from the settings, rebuilt as a whole when they change."""
+
+    # dataclass(slots=True) needs python 3.10
+    __slots__ = (
+        "terminal",
+        "terminal_data",
+        "cmd",
+        "new_tab",
+        "flatpak",
+        "open_local",
+        "open_remote",
+        "labels",
+    )
+
+    terminal: str
+    terminal_data: Terminal
+    cmd: tuple[str, ...]
+    new_tab: bool
+    flatpak: str
+    open_local: Callable[[str], None]
+    open_remote: Callable[..., None]
+    labels: Mapping[str, str]
+
+
+_TERMINALS = {
     "alacritty": Terminal("Alacritty"),
     "blackbox": Terminal(
         "Black Box",
@@ -92,136 +112,290 @@ TERMINALS = {
     "xfce4-terminal": Terminal("Xfce Terminal", new_tab_arguments=["--tab"]),
     "xterm": Terminal("XTerm"),
 }
+# read-only so nothing can mutate it behind the caches built from it, interned keys for cheaper lookups
+TERMINALS: Mapping[str, Terminal] = MappingProxyType({sys.intern(key): value for key, value in _TERMINALS.items()})
+del _TERMINALS
 
 FLATPAK_PARMS = ["off", "system", "user"]
 
-terminal = "gnome-terminal"
-terminal_cmd: list[str] = None  # type: ignore
-terminal_data: Terminal = TERMINALS["gnome-terminal"]
-new_tab = False
-flatpak = FLATPAK_PARMS[0]
-
 GSETTINGS_PATH = "com.github.stunkymonkey.nautilus-open-any-terminal"
-GSETTINGS_KEYBINDINGS = "keybindings"
-GSETTINGS_TERMINAL = "terminal"
-GSETTINGS_NEW_TAB = "new-tab"
-GSETTINGS_FLATPAK = "flatpak"
-REMOTE_URI_SCHEME = ["ftp", "sftp"]
+GSETTINGS_KEYBINDINGS = sys.intern("keybindings")
+GSETTINGS_TERMINAL = sys.intern("terminal")
+GSETTINGS_NEW_TAB = sys.intern("new-tab")
+GSETTINGS_FLATPAK = sys.intern("flatpak")
+REMOTE_URI_SCHEME = frozenset(("ftp", "sftp"))
+LOCAL_URI_PREFIX = "file://"  # followed by the absolute path, GIO never sets an authority for local files
+OS_RELEASE_PATHS = ["/etc/os-release", "/usr/lib/os-release"]
+
+# one alternation over all remote schemes, checks the uri prefix without splitting the uri;
+# schemes are case-insensitive, as urlparse treats them
+_REMOTE_URI = re.compile(rf"\A(?:{'|'.join(map(re.escape, sorted(REMOTE_URI_SCHEME)))}):", re.IGNORECASE).match
+# same character class shlex.quote considers safe, so paths matching it can be passed through as is
+_SAFE_PATH = re.compile(r"\A[\w@%+=:,./-]+\Z", re.ASCII).match
 
 _ = gettext
+# module-level only, installing into builtins would leak `_` into every other extension in the process
 for localedir in [expanduser("~/.local/share/locale"), "/usr/share/locale"]:
+    if not os.path.isdir(localedir):
+        continue
     try:
-        trans = translation("nautilus-open-any-terminal", localedir)
-        trans.install()
-        _ = trans.gettext
+        _ = translation("nautilus-open-any-terminal", localedir).gettext
         break
     except FileNotFoundError:
         continue
 
 
+def _is_os_release_key(key: str) -> bool:
+    """check that key matches `[A-Z][A-Z_0-9]+` without going through the regex engine"""
+    return len(key) > 1 and "A" <= key[0] <= "Z" and all("A" <= c <= "Z" or "0" <= c <= "9" or c == "_" for c in key)
+
+
+def _unquote_os_release(val: str) -> Optional[str]:
+    """strip the quotes of an os-release value and resolve its escapes, None if it is not properly quoted"""
+    quote = val[0]
+    if len(val) < 2 or val[-1] != quote:
+        return None
+    val = val[1:-1]
+    if "\\" not in val:
+        return None if quote in val else val
+    chars = []
+    escaped = False
+    for char in val:
+        if escaped:
+            chars.append("\n" if char == "n" else char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == quote:
+            return None
+        else:
+            chars.append(char)
+    if escaped:
+        # the backslash escaped the closing quote
+        return None
+    return "".join(chars)
+
+
 # Adapted from https://www.freedesktop.org/software/systemd/man/latest/os-release.html
 def read_os_release():
     """Read and parse the OS release information."""
-    possible_os_release_paths = ["/etc/os-release", "/usr/lib/os-release"]
-    for file_path in possible_os_release_paths:
+    for file_path in OS_RELEASE_PATHS:
+        if not os.path.isfile(file_path):
+            continue
         try:
             with open(file_path, mode="r", encoding="utf-8") as os_release:
-                for line_number, line in enumerate(os_release, start=1):
+                for line_number, line in enumerate(os_release.read().splitlines(), start=1):
                     line = line.rstrip()
                     if not line or line.startswith("#"):
                         continue
-                    result = re.match(r"([A-Z][A-Z_0-9]+)=(.*)", line)
-                    if result:
-                        name, val = result.groups()
-                        if val and val[0] in "\"'":
-                            val = ast.literal_eval(val)
-                        yield name, val
-                    else:
+                    name, sep, val = line.partition("=")
+                    if not sep or not _is_os_release_key(name):
                         raise OSError(f"{file_path}:{line_number}: bad line {line!r}")
+                    if val and val[0] in "\"'":
+                        unquoted = _unquote_os_release(val)
+                        if unquoted is None:
+                            raise OSError(f"{file_path}:{line_number}: bad line {line!r}")
+                        val = unquoted
+                    yield name, val
         except FileNotFoundError:
             continue
 
 
-@cache
+def _os_release_mtimes():
+    """stat the os-release candidates, used to detect when they are rewritten"""
+    mtimes = []
+    for file_path in OS_RELEASE_PATHS:
+        try:
+            mtimes.append(os.stat(file_path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+_distro_id_cache: dict = {"mtime": None, "id": "unknown"}
+
+
 def distro_id():
     """get the name of your linux distribution"""
-    try:
-        return dict(read_os_release())["ID"]
-    except OSError:
-        return "unknown"
+    mtimes = _os_release_mtimes()
+    if _distro_id_cache["mtime"] != mtimes:
+        value = "unknown"
+        try:
+            # stop at the first ID instead of parsing the rest of the file(s)
+            for name, val in read_os_release():
+                if name == "ID":
+                    value = val
+                    break
+        except OSError:
+            pass
+        _distro_id_cache["mtime"] = mtimes
+        _distro_id_cache["id"] = value
+    return _distro_id_cache["id"]
 
 
-def open_terminal_in_uri(uri: str):
-    """open the new terminal with correct path"""
-    result = urlparse(uri)
-    cmd = terminal_cmd.copy()
-    if result.scheme in REMOTE_URI_SCHEME:
-        cmd.extend(terminal_data.command_arguments)
-        cmd.extend(["ssh", "-t"])
-        if result.username:
-            cmd.append(f"{result.username}@{result.hostname}")
-        else:
-            cmd.append(result.hostname)
+def _quote(path: str) -> str:
+    """shell-quote path, skipping shlex for the common case of a path without special characters"""
+    if _SAFE_PATH(path):
+        return path
+    import shlex  # pylint: disable=import-outside-toplevel
+
+    return shlex.quote(path)
+
 
-        if result.port:
-            cmd.append("-p")
-            cmd.append(str(result.port))
+_spawned_pids: set[int] = set()
 
-        cmd.extend(["cd", shlex.quote(unquote(result.path)), ";", "exec", "$SHELL"])
 
-        Popen(cmd)  # pylint: disable=consider-using-with
+def _reap_spawned():
+    """collect terminals started with posix_spawnp that exited, nothing else waits for them"""
+    for pid in list(_spawned_pids):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                continue
+        except ChildProcessError:
+            pass
+        _spawned_pids.discard(pid)
+
+
+def _spawn(cmd: Sequence[str], cwd: Optional[str] = None):
+    """start cmd without forking the (possibly large) Nautilus process where possible"""
+    _reap_spawned()
+    # os.posix_spawn has no way to change the directory of the child, and can only close the inherited
+    # descriptors like Popen's close_fds with POSIX_SPAWN_CLOSEFROM (python 3.13+), otherwise use Popen
+    if cwd is None and hasattr(os, "POSIX_SPAWN_CLOSEFROM"):
+        file_actions = [(os.POSIX_SPAWN_CLOSEFROM, 3)]
+        _spawned_pids.add(os.posix_spawnp(cmd[0], list(cmd), os.environ, file_actions=file_actions))
+        return
+    Popen(cmd, cwd=cwd)  # pylint: disable=consider-using-with
+
+
+def _make_local_opener(local_prefix: tuple[str, ...], local_workdir_prefix: Optional[tuple[str, ...]]):
+    """specialize opening a local directory to the configured terminal, so no settings are checked per click"""
+    if local_workdir_prefix is None:
+
+        def open_local(filename: str):
+            _spawn(local_prefix, cwd=filename)
+
+    else:
+
+        def open_local(filename: str):
+            cmd = (*local_workdir_prefix, filename) if filename else local_prefix
+            _spawn(cmd, cwd=filename)
+
+    return open_local
+
+
+def _make_remote_opener(remote_prefix: tuple[str, ...]):
+    """specialize opening a remote directory over ssh to the configured terminal"""
+
+    def open_remote(result, path: str):
+        host = f"{result.username}@{result.hostname}" if result.username else result.hostname
+        port = ("-p", str(result.port)) if result.port else ()
+        cmd = [*remote_prefix, host, *port, "cd", _quote(path), ";", "exec", "$SHELL"]
+        _spawn(cmd)
+
+    return open_remote
+
+
+def open_terminal_in_uri(uri: str):
+    """open the new terminal with correct path"""
+    # only needed once a terminal is opened, keep them off the extension's import path
+    from urllib.parse import unquote, urlparse  # pylint: disable=import-outside-toplevel
+
+    if _REMOTE_URI(uri):
+        result = urlparse(uri)
+        _CFG.open_remote(result, unquote(result.path))
+    elif uri.startswith(LOCAL_URI_PREFIX + "/"):
+        _CFG.open_local(unquote(uri[len(LOCAL_URI_PREFIX) :]))
     else:
-        filename = unquote(result.path)
-        if new_tab and terminal_data.new_tab_arguments:
-            cmd.extend(terminal_data.new_tab_arguments)
-        elif terminal_data.new_window_arguments:
-            cmd.extend(terminal_data.new_window_arguments)
+        _CFG.open_local(unquote(urlparse(uri).path))
+
+
+def _build_menu_labels(name: str) -> dict[str, str]:
+    """translate the menu labels and tips that only depend on the terminal name"""
+    return {
+        "open_remote_item": _("Open Remote {}").format(name),
+        "open_file_item": _("Open In {}").format(name),
+        "open_bg_remote_item": _("Open Remote {} Here").format(name),
+        "open_bg_remote_tip": _("Open Remote {} In This Directory").format(name),
+        "open_bg_file_item": _("Open {} Here").format(name),
+        "open_bg_file_tip": _("Open {} In This Directory").format(name),
+    }
+
+
+def _build_cmd(terminal_key: str, flatpak_mode: str) -> tuple[str, ...]:
+    """resolve the command starting terminal_key, either natively or through flatpak"""
+    flatpak_package = TERMINALS[terminal_key].flatpak_package
+    if flatpak_mode != FLATPAK_PARMS[0] and flatpak_package is not None:
+        return ("flatpak", "run", "--" + flatpak_mode, flatpak_package)
+    if terminal_key == "blackbox" and distro_id() == "fedora":
+        # It's called like this on fedora
+        return ("blackbox-terminal",)
+    return (terminal_key,)
+
+
+def _build_config(terminal: str, new_tab: bool, flatpak: str) -> Config:
+    """resolve everything needed to open terminal from the raw settings"""
+    terminal_data = TERMINALS[terminal]
+    new_tab = new_tab and bool(terminal_data.new_tab_arguments)
+    if terminal_data.flatpak_package is None:
+        flatpak = FLATPAK_PARMS[0]
+    cmd = _build_cmd(terminal, flatpak)
 
-        if filename and terminal_data.workdir_arguments:
-            cmd.extend(terminal_data.workdir_arguments)
-            cmd.append(filename)
+    if new_tab:
+        # new_tab is only set when the terminal has new_tab_arguments, `or ()` just narrows the type
+        local_prefix = (*cmd, *(terminal_data.new_tab_arguments or ()))
+    elif terminal_data.new_window_arguments:
+        local_prefix = (*cmd, *terminal_data.new_window_arguments)
+    else:
+        local_prefix = cmd
+    local_workdir_prefix: Optional[tuple[str, ...]] = None
+    if terminal_data.workdir_arguments:
+        local_workdir_prefix = (*local_prefix, *terminal_data.workdir_arguments)
 
-        Popen(cmd, cwd=filename)  # pylint: disable=consider-using-with
+    return Config(
+        terminal=terminal,
+        terminal_data=terminal_data,
+        cmd=cmd,
+        new_tab=new_tab,
+        flatpak=flatpak,
+        open_local=_make_local_opener(local_prefix, local_workdir_prefix),
+        open_remote=_make_remote_opener((*cmd, *terminal_data.command_arguments, "ssh", "-t")),
+        labels=_build_menu_labels(terminal_data.name),
+    )
+
+
+# built at import, so it must stay cheap: gnome-terminal does not depend on the distro and never reads os-release
+_CFG = _build_config("gnome-terminal", False, FLATPAK_PARMS[0])
 
 
 def set_terminal_args(*_args):
-    """set the terminal_cmd to the correct values"""
-    global new_tab
-    global flatpak
-    global terminal_cmd
-    global terminal_data
+    """set the terminal configuration to the correct values"""
+    global _CFG
     value = _gsettings.get_string(GSETTINGS_TERMINAL)
     newer_tab = _gsettings.get_boolean(GSETTINGS_NEW_TAB)
     flatpak = FLATPAK_PARMS[_gsettings.get_enum(GSETTINGS_FLATPAK)]
-    new_terminal_data = TERMINALS.get(value)
-    if not new_terminal_data:
+    if value not in TERMINALS:
         print(f'open-any-terminal: unknown terminal "{value}"')
         return
 
-    global terminal
-    terminal = value
-    terminal_data = new_terminal_data
-    if newer_tab and terminal_data.new_tab_arguments:
-        new_tab = newer_tab
+    _CFG = _build_config(value, newer_tab, flatpak)
+    if _CFG.new_tab:
         new_tab_text = "opening in a new tab"
     else:
         new_tab_text = "opening a new window"
-    if newer_tab and not terminal_data.new_tab_arguments:
+    if newer_tab and not _CFG.terminal_data.new_tab_arguments:
         new_tab_text += " (terminal does not support tabs)"
-    if flatpak != FLATPAK_PARMS[0] and terminal_data.flatpak_package is not None:
-        terminal_cmd = ["flatpak", "run", "--" + flatpak, terminal_data.flatpak_package]
-        flatpak_text = f"with flatpak as {flatpak}"
-    else:
-        terminal_cmd = [terminal]
-        if terminal == "blackbox" and distro_id() == "fedora":
-            # It's called like this on fedora
-            terminal_cmd[0] = "blackbox-terminal"
-        flatpak = FLATPAK_PARMS[0]
-        flatpak_text = ""
-    print(f'open-any-terminal: terminal is set to "{terminal}" {new_tab_text} {flatpak_text}')
+    flatpak_text = f"with flatpak as {_CFG.flatpak}" if _CFG.flatpak != FLATPAK_PARMS[0] else ""
+    print(f'open-any-terminal: terminal is set to "{_CFG.terminal}" {new_tab_text} {flatpak_text}')
 
 
 if API_VERSION == "3.0":
+    from gi.repository import Gtk  # pylint: disable=ungrouped-imports
+
+    @lru_cache(maxsize=8)
+    def _parse_accel(shortcut: str):
+        """parse shortcut once per distinct value, every window's provider rebinds the same one"""
+        return Gtk.accelerator_parse(shortcut)
 
     class OpenAnyTerminalShortcutProvider(
         GObject.GObject, Nautilus.LocationWidgetProvider
@@ -240,7 +414,7 @@ if API_VERSION == "3.0":
         def _create_accel_group(self):
             self._accel_group = Gtk.AccelGroup()
             shortcut = self._gsettings.get_string(GSETTINGS_KEYBINDINGS)
-            key, mod = Gtk.accelerator_parse(shortcut)
+            key, mod = _parse_accel(shortcut)
             self._accel_group.connect(key, mod, Gtk.AccelFlags.VISIBLE, self._open_terminal)
 
         def _bind_shortcut(self, _gsettings, key):
@@ -264,8 +438,8 @@ if API_VERSION == "3.0":
 class OpenAnyTerminalExtension(GObject.GObject, Nautilus.MenuProvider):
     """Provide context menu items for opening terminals in Nautilus."""
 
-    def _menu_activate_cb(self, menu, file_):
-        open_terminal_in_uri(file_.get_uri())
+    def _menu_activate_cb(self, menu, uri):
+        open_terminal_in_uri(uri)
 
     def get_file_items(self, *args):
         """Generates a list of menu items for a file or folder in the Nautilus file manager."""
@@ -280,21 +454,22 @@ class OpenAnyTerminalExtension(GObject.GObject, Nautilus.MenuProvider):
         file_ = files[0]
 
         if file_.is_directory():
-            if file_.get_uri_scheme() in REMOTE_URI_SCHEME:
-                uri = file_.get_uri()
+            # fetch the uri once and check the scheme on it, every FileInfo call goes through GI
+            uri = file_.get_uri()
+            if _REMOTE_URI(uri):
                 item = Nautilus.MenuItem(
                     name="OpenTerminal::open_remote_item",
-                    label=_("Open Remote {}").format(terminal_data.name),
-                    tip=_("Open Remote {} In {}").format(terminal_data.name, uri),
+                    label=_CFG.labels["open_remote_item"],
+                    tip=_("Open Remote {} In {}").format(_CFG.terminal_data.name, uri),
                 )
             else:
                 filename = file_.get_name()
                 item = Nautilus.MenuItem(
                     name="OpenTerminal::open_file_item",
-                    label=_("Open In {}").format(terminal_data.name),
-                    tip=_("Open {} In {}").format(terminal_data.name, filename),
+                    label=_CFG.labels["open_file_item"],
+                    tip=_("Open {} In {}").format(_CFG.terminal_data.name, filename),
                 )
-            item.connect("activate", self._menu_activate_cb, file_)
+            item.connect("activate", self._menu_activate_cb, uri)
             items.append(item)
 
         return items
@@ -307,19 +482,20 @@ class OpenAnyTerminalExtension(GObject.GObject, Nautilus.MenuProvider):
         file_ = args[-1]
 
         items = []
-        if file_.get_uri_scheme() in REMOTE_URI_SCHEME:
+        uri = file_.get_uri()
+        if _REMOTE_URI(uri):
             item = Nautilus.MenuItem(
                 name="OpenTerminal::open_bg_remote_item",
-                label=_("Open Remote {} Here").format(terminal_data.name),
-                tip=_("Open Remote {} In This Directory").format(terminal_data.name),
+                label=_CFG.labels["open_bg_remote_item"],
+                tip=_CFG.labels["open_bg_remote_tip"],
             )
         else:
             item = Nautilus.MenuItem(
                 name="OpenTerminal::open_bg_file_item",
-                label=_("Open {} Here").format(terminal_data.name),
-                tip=_("Open {} In This Directory").format(terminal_data.name),
+                label=_CFG.labels["open_bg_file_item"],
+                tip=_CFG.labels["open_bg_file_tip"],
             )
-        item.connect("activate", self._menu_activate_cb, file_)
+        item.connect("activate", self._menu_activate_cb, uri)
         items.append(item)
         return items
 